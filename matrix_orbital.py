@@ -20,8 +20,10 @@
 # (at your option) any later version.
 
 from enum import Enum
-from gi.repository import Gtk
-from math import floor
+from functools import lru_cache
+from gi.repository import GLib, Gtk
+import os
+import threading
 from platform import system
 from quodlibet import _, app
 from quodlibet.plugins import ConfProp, PluginConfig
@@ -42,6 +44,19 @@ class Config(object):
 CONFIG = Config()
 
 
+@lru_cache(maxsize=2048)
+def _uni(text):
+
+    # Artists and albums repeat across tracks, so cache transliterations.
+    return unidecode(text)
+
+
+def _tl(text):
+
+    # Plain ASCII needs no transliteration.
+    return text if text.isascii() else _uni(text)
+
+
 class Alignment(Enum):
 
     LEFT = 1
@@ -60,6 +75,9 @@ class Phase(Enum):
     DISC_INFO = 5
     HEADER_INFO = 6
 
+# Phases are cycled through in this order.
+_PHASES = tuple(Phase)
+
 
 class NowPlayingLCDData(object):
 
@@ -67,74 +85,133 @@ class NowPlayingLCDData(object):
 
         self._parent = parent
         self._max_width = int(CONFIG.lcd_width)
-        self._interval = float(CONFIG.lcd_interval)
+        self._ticks_per_sec = 1000 / float(CONFIG.lcd_interval)
         self._ticks_in_phase = self._seconds_to_ticks(4)
+        # Tick counts per phase, the header is shown for half the time.
+        self._header_ticks = self._ticks_in_phase // 2
+        self._phase_ticks = (
+            self._ticks_in_phase,
+            self._ticks_in_phase,
+            self._ticks_in_phase,
+            self._ticks_in_phase,
+            self._ticks_in_phase,
+            self._header_ticks)
+        # Tick and redraw handlers in the same order as _PHASES.
+        self._handlers = (
+            self._tick_basic_info,
+            self._tick_basic_scroll,
+            self._tick_basic_info,
+            self._tick_basic_scroll,
+            self._tick_disc_info,
+            self._tick_header_info)
+        self._redraw_handlers = (
+            self._redraw_basic_info,
+            self._redraw_basic_scroll,
+            self._redraw_basic_info,
+            self._redraw_basic_scroll,
+            self._redraw_disc_info,
+            self._redraw_header_info)
         self.reset()
 
-    def set_basic_info(self, artist, title):
+    def prepare_info(self, artist, title, album, discnumber, tracknumber):
+
+        # Only computes the song data, so this is safe to call from
+        # a worker thread. The result is taken into use by set_info.
+        return (self._prepare_basic_info(artist, title) +
+            self._prepare_disc_info(album, discnumber, tracknumber))
+
+    def set_info(self, info):
 
-        self._artist = unidecode(artist)
-        self._title = unidecode(title)
+        (self._artist, self._title,
+            self._artist_ring, self._title_ring, self._info_bytes,
+            self._disc_info_bytes) = info
+
+    def _prepare_basic_info(self, artist, title):
+
+        # Text is only ever written to the LCD, so keep it as bytes.
+        artist = _tl(artist).encode("ascii")
+        title = _tl(title).encode("ascii")
 
         # If the text should scroll, pad it to scroll width.
-        if len(self._artist) > self._max_width:
-            self._artist += "".ljust(self._max_width)
-        if len(self._title) > self._max_width:
-            self._title += "".ljust(self._max_width)
+        # Scrolled text is sliced from a doubled copy of the text.
+        artist_ring = artist
+        title_ring = title
+        if len(artist) > self._max_width:
+            artist += b" " * self._max_width
+            artist_ring = artist + artist
+        if len(title) > self._max_width:
+            title += b" " * self._max_width
+            title_ring = title + title
+
+        info_bytes = \
+            self._text2bytes(artist, Alignment.TOP) + \
+            self._text2bytes(title, Alignment.BOTTOM)
+
+        return (artist, title, artist_ring, title_ring, info_bytes)
 
-    def set_disc_info(self, album, discnumber, tracknumber):
+    def _prepare_disc_info(self, album, discnumber, tracknumber):
 
-        self._disc_info_row_1 = ""
-        self._disc_info_row_2 = ""
+        disc_info_row_1 = ""
+        disc_info_row_2 = ""
 
         if album is not None:
-            tlalbum = unidecode(album)
+            tlalbum = _tl(album)
             if len(tlalbum) > self._max_width:
                 tlalbum = tlalbum[0:self._max_width - 3] + "..."
-            self._disc_info_row_1 = tlalbum
+            disc_info_row_1 = tlalbum
 
         if discnumber is not None:
-            self._disc_info_row_2 = \
-                _("Disc") + " " + unidecode(discnumber) + " "
+            disc_info_row_2 = \
+                _("Disc") + " " + _tl(discnumber) + " "
 
         if tracknumber is not None:
-            self._disc_info_row_2 += \
-                (_("Track") + " " + unidecode(tracknumber)) \
-                .rjust(self._max_width - len(self._disc_info_row_2))
+            disc_info_row_2 += \
+                (_("Track") + " " + _tl(tracknumber)) \
+                .rjust(self._max_width - len(disc_info_row_2))
+
+        disc_info_bytes = \
+            self._text2bytes(
+                _tl(disc_info_row_1).encode("ascii"), Alignment.TOP) + \
+            self._text2bytes(
+                _tl(disc_info_row_2).encode("ascii"), Alignment.BOTTOM)
+
+        return (disc_info_bytes,)
 
     def reset(self):
 
         self._artist = None
         self._title = None
-        self._disc_info_row_1 = ""
-        self._disc_info_row_2 = ""
+        self._artist_ring = None
+        self._title_ring = None
+        self._info_bytes = b""
+        self._disc_info_bytes = b""
         self._skip_ticks = 0
         self._scroll_a = 0
         self._scroll_t = 0
-        self._tick_count = 0
-        self._phase = Phase.BASIC_INFO
-        self._force_refresh = True
+        self._phase_idx = 0
+        self._ticks_left = self._phase_ticks[0]
+        self._phase = _PHASES[0]
+        self._tick = self._tick_redraw
 
     def prevent_update(self, seconds):
 
         if seconds < 0:
             self._skip_ticks = -1
         else:
-            self._skip_ticks = self._seconds_to_ticks(seconds)
+            self._parent.pause_ticks(seconds)
 
     def set_forced_update(self):
 
-        self._force_refresh = True
+        self._tick = self._tick_redraw
 
     def _seconds_to_ticks(self, seconds):
 
-        return int(round(seconds * (1000 / self._interval)))
+        return int(round(seconds * self._ticks_per_sec))
 
     def _advance_phase(self):
 
         self._scroll_a = 0
         self._scroll_t = 0
-        self._tick_count = 0
 
         # Don't scroll if there is no need to.
         if (len(self._artist) <= self._max_width):
@@ -142,129 +219,122 @@ class NowPlayingLCDData(object):
         if (len(self._title) <= self._max_width):
             self._scroll_t = -1
 
-        next_phases = {
-            Phase.BASIC_INFO: Phase.BASIC_SCROLL,
-            Phase.BASIC_SCROLL: Phase.BASIC_INFO_2,
-            Phase.BASIC_INFO_2: Phase.BASIC_SCROLL_2,
-            Phase.BASIC_SCROLL_2: Phase.DISC_INFO,
-            Phase.DISC_INFO: Phase.HEADER_INFO,
-            Phase.HEADER_INFO: Phase.BASIC_INFO
-            }
-        self._phase = next_phases.get(self._phase, Phase.HEADER_INFO)
+        self._phase_idx = (self._phase_idx + 1) % len(_PHASES)
+        self._phase = _PHASES[self._phase_idx]
+        self._ticks_left = self._phase_ticks[self._phase_idx]
 
-        self._force_refresh = True
+        # Redraw the whole display on the first tick of the new phase.
+        self._tick = self._tick_redraw
 
     def on_tracker_tick(self, tracker):
 
+        # Send everything written during the tick with a single write.
+        self._update()
+        self._parent.flush_bytes()
+
+    def _update(self):
+
         if (self._artist is None or
             self._title is None or
             self._skip_ticks < 0):
             return
 
-        if self._skip_ticks > 0:
-            self._skip_ticks -= 1
-            # If resuming after skipped ticks, force refresh.
-            # This makes sure there is no garbage on the display.
-            if self._skip_ticks == 0:
-                self._force_refresh = True
-            return
+        self._ticks_left -= 1
+        self._tick()
+
+    def _tick_redraw(self):
 
-        self._tick_count += 1
+        self._redraw_handlers[self._phase_idx]()
+        self._tick = self._handlers[self._phase_idx]
+        self._tick()
+
+    def _redraw_basic_info(self):
 
         # Display static basic info.
-        if (self._phase == Phase.BASIC_INFO or
-            self._phase == Phase.BASIC_INFO_2):
+        self._parent.reset_lcd()
+        self._parent.write_bytes(self._info_bytes)
 
-            if (self._force_refresh):
-                self._force_refresh = False
-                self._parent.reset_lcd()
-                self._refresh_info()
+    def _redraw_basic_scroll(self):
 
-            if (self._tick_count > self._ticks_in_phase):
-                self._advance_phase()
+        # Lines still scrolling are written by the tick handler.
+        self._parent.reset_lcd()
+        self._refresh_info(self._scroll_a == -1, self._scroll_t == -1)
 
-            return
+    def _redraw_disc_info(self):
 
-        # Display scrolling basic info.
-        if (self._phase == Phase.BASIC_SCROLL or
-            self._phase == Phase.BASIC_SCROLL_2):
+        # Display disc info.
+        self._parent.reset_lcd()
+        self._parent.write_bytes(self._disc_info_bytes)
 
-            # Value -1 indicates scrolling is done.
-            refresh_artist = self._scroll_a > -1 or self._force_refresh
-            refresh_title = self._scroll_t > -1 or self._force_refresh
+    def _redraw_header_info(self):
 
-            if (self._tick_count > self._ticks_in_phase and
-                self._scroll_a == -1 and self._scroll_t == -1):
-                self._advance_phase()
-                return
+        # Display generic status.
+        self._parent.write_header_with_text(_("* now playing *"))
 
-            if self._force_refresh:
-                self._force_refresh = False
-                self._parent.reset_lcd()
+    def _tick_basic_info(self):
 
-            if self._scroll_a > -1:
-                self._scroll_a += 1
-                if self._scroll_a > len(self._artist):
-                    self._scroll_a = -1
+        if (self._ticks_left < 0):
+            self._advance_phase()
 
-            if self._scroll_t > -1:
-                self._scroll_t += 1
-                if self._scroll_t > len(self._title):
-                    self._scroll_t = -1
+    def _tick_basic_scroll(self):
 
-            if refresh_artist:
-                self._refresh_info(True, False)
-            if refresh_title:
-                self._refresh_info(False)
+        # Display scrolling basic info.
+        # Value -1 indicates scrolling is done.
+        refresh_artist = self._scroll_a > -1
+        refresh_title = self._scroll_t > -1
 
+        if (self._ticks_left < 0 and
+            not refresh_artist and not refresh_title):
+            self._advance_phase()
             return
 
-        # Display disc info.
-        if self._phase == Phase.DISC_INFO:
+        if self._scroll_a > -1:
+            self._scroll_a += 1
+            if self._scroll_a > len(self._artist):
+                self._scroll_a = -1
 
-            if self._force_refresh:
-                self._force_refresh = False
-                self._parent.reset_lcd()
-                self._refresh_disc_info()
+        if self._scroll_t > -1:
+            self._scroll_t += 1
+            if self._scroll_t > len(self._title):
+                self._scroll_t = -1
 
-            if self._tick_count > self._ticks_in_phase:
-                self._advance_phase()
+        if refresh_artist:
+            self._refresh_info(True, False)
+        if refresh_title:
+            self._refresh_info(False)
 
-            return
+    def _tick_disc_info(self):
 
-        # Display generic status.
-        if self._phase == Phase.HEADER_INFO:
+        if self._ticks_left < 0:
+            self._advance_phase()
 
-            if self._force_refresh:
-                self._force_refresh = False
-                self._parent.reset_lcd()
-                self._parent.write_header_with_text(_("* now playing *"))
+    def _tick_header_info(self):
 
-            if self._tick_count > self._ticks_in_phase / 2:
-                self._advance_phase()
+        if self._ticks_left < 0:
+            self._advance_phase()
 
-            return
+    def _text2bytes(self, text, v_align):
 
-    def _write_text(self, text, scroll, v_align):
+        return self._parent.align_text2bytes(
+            text[0:self._max_width], Alignment.LEFT, v_align)
 
-        if scroll is not None and scroll > 0:
-            text = (text[scroll:] + text)
-        text = text[0:self._max_width]
+    def _write_text(self, ring, scroll, v_align):
+
+        if scroll > 0:
+            text = ring[scroll:scroll + self._max_width]
+        else:
+            text = ring[0:self._max_width]
         self._parent.write_bytes(
             self._parent.align_text2bytes(text, Alignment.LEFT, v_align))
 
-    def _refresh_disc_info(self):
-
-        self._write_text(self._disc_info_row_1, None, Alignment.TOP)
-        self._write_text(self._disc_info_row_2, None, Alignment.BOTTOM)
-
     def _refresh_info(self, artist=True, title=True):
 
         if artist:
-            self._write_text(self._artist, self._scroll_a, Alignment.TOP)
+            self._write_text(self._artist_ring, self._scroll_a, Alignment.TOP)
 
         if title:
-            self._write_text(self._title, self._scroll_t, Alignment.BOTTOM)
+            self._write_text(
+                self._title_ring, self._scroll_t, Alignment.BOTTOM)
 
 
 class MatrixOrbitalLCD(EventPlugin):
@@ -278,21 +348,15 @@ class MatrixOrbitalLCD(EventPlugin):
     def align_text2bytes(self, text,
         h_align=Alignment.CENTER, v_align=Alignment.TOP):
 
-        if (h_align == Alignment.LEFT):
+        if (h_align is Alignment.LEFT):
             index = 1
-        elif (h_align == Alignment.RIGHT):
-            index = max(CONFIG.lcd_width - len(text) + 1, 1)
-        elif (h_align == Alignment.CENTER):
-            index = floor((int(CONFIG.lcd_width) - len(text)) / 2) + 1
+        elif (h_align is Alignment.RIGHT):
+            index = max(self._lcd_width - len(text) + 1, 1)
+        elif (h_align is Alignment.CENTER):
+            index = max((self._lcd_width - len(text)) // 2 + 1, 1)
 
-        alignment = b"\xFEG" + bytes(chr(index), "utf8")
-
-        if v_align == Alignment.TOP:
-            alignment += b"\x01"
-        elif v_align == Alignment.BOTTOM:
-            alignment += b"\x02"
-
-        return alignment + bytes(text, "utf8")
+        # Text is given as transliterated ASCII bytes.
+        return self._prefixes[(index, v_align)] + text
 
     def reset_lcd(self):
 
@@ -301,18 +365,67 @@ class MatrixOrbitalLCD(EventPlugin):
 
     def write_bytes(self, text):
 
-        self._dev.write(text)
+        # Writes are buffered until flush_bytes is called.
+        self._pending += text
+
+    def flush_bytes(self):
+
+        if self._pending:
+            os.write(self._fd, self._pending)
+            self._pending.clear()
+
+    def pause_ticks(self, seconds):
+
+        # Stop receiving ticks altogether instead of discarding them.
+        if self._resume_id is not None:
+            GLib.source_remove(self._resume_id)
+        else:
+            self._tracker.disconnect(self._tick_handler_id)
+        self._resume_id = GLib.timeout_add(
+            int(seconds * 1000), self._on_resume_timeout)
+
+    def resume_ticks(self):
+
+        if self._resume_id is None:
+            return
+
+        GLib.source_remove(self._resume_id)
+        self._on_resume_timeout()
+
+    def _on_resume_timeout(self):
+
+        self._resume_id = None
+        self._tick_handler_id = self._tracker.connect(
+            'tick', self._npld.on_tracker_tick)
+
+        # If resuming after skipped ticks, force refresh.
+        # This makes sure there is no garbage on the display.
+        self._npld.set_forced_update()
+        return False
 
     def write_header_with_text(self, text=""):
 
-        self.reset_lcd()
-        self._write_header()
-        self.write_bytes(
-            self.align_text2bytes(text, Alignment.CENTER, Alignment.BOTTOM))
+        # Status texts are constant, so their output is built beforehand.
+        blob = self._header_blobs.get(text)
+        if blob is None:
+            blob = self._header_with_text2bytes(text)
+        self.write_bytes(blob)
+        self.flush_bytes()
+
+    def _header_with_text2bytes(self, text):
+
+        # Empty LCD screen (X) and send cursor home (H).
+        return b"\xFEX\xFEH" + self._header2bytes() + \
+            self.align_text2bytes(
+                _tl(text).encode("ascii"), Alignment.CENTER, Alignment.BOTTOM)
+
+    def _header2bytes(self, header="Quod Libet"):
+
+        return self.align_text2bytes(_tl(header).encode("ascii"))
 
     def _write_header(self, header="Quod Libet"):
 
-        self.write_bytes(self.align_text2bytes(header))
+        self.write_bytes(self._header2bytes(header))
 
     def PluginPreferences(self, parent):
 
@@ -324,6 +437,7 @@ class MatrixOrbitalLCD(EventPlugin):
                 CONFIG.lcd_width = int(entry.get_text())
             except:
                 CONFIG.lcd_width = 20
+            self._update_lcd_width()
 
         def _interval_changed(entry):
             try:
@@ -366,6 +480,23 @@ class MatrixOrbitalLCD(EventPlugin):
         vbox.pack_start(hbox, True, True, 6)
         return vbox
 
+    def _update_lcd_width(self):
+
+        self._lcd_width = int(CONFIG.lcd_width)
+
+        # Cursor positioning commands (G) for every column on both rows.
+        self._prefixes = {}
+        for index in range(1, self._lcd_width + 1):
+            self._prefixes[(index, Alignment.TOP)] = \
+                b"\xFEG" + bytes([index]) + b"\x01"
+            self._prefixes[(index, Alignment.BOTTOM)] = \
+                b"\xFEG" + bytes([index]) + b"\x02"
+
+        self._header_blobs = {}
+        for text in (_("* now playing *"), _("* paused *"),
+            _("* not playing *")):
+            self._header_blobs[text] = self._header_with_text2bytes(text)
+
     def _failed_initialization(self):
 
         if not hasattr(self, "_dev"):
@@ -385,6 +516,9 @@ class MatrixOrbitalLCD(EventPlugin):
             print_e("Matrix Orbital LCD device not found at " + CONFIG.lcd_dev)
             return
 
+        self._fd = self._dev.fileno()
+        self._pending = bytearray()
+        self._update_lcd_width()
         self.reset_lcd()
 
         # Ready horizontal bars.
@@ -393,10 +527,14 @@ class MatrixOrbitalLCD(EventPlugin):
         self.write_bytes(b"\xFEB\x00")
 
         self._write_header()
+        self.flush_bytes()
 
         self._npld = NowPlayingLCDData(self)
         self._tracker = TimeTracker(app.player)
-        self._tracker.connect('tick', self._npld.on_tracker_tick)
+        self._tick_handler_id = self._tracker.connect(
+            'tick', self._npld.on_tracker_tick)
+        self._resume_id = None
+        self._song = None
         self._tracker.set_interval(int(CONFIG.lcd_interval))
 
     def disabled(self):
@@ -404,11 +542,13 @@ class MatrixOrbitalLCD(EventPlugin):
         if self._failed_initialization():
             return
 
+        self.resume_ticks()
         self._tracker.destroy()
         self.reset_lcd()
 
         # Turn backlight off.
         self.write_bytes(b"\xFEF")
+        self.flush_bytes()
 
     def plugin_on_seek(self, song, msec):
 
@@ -425,23 +565,44 @@ class MatrixOrbitalLCD(EventPlugin):
         # to the right (0), with a length of 0-100 pixels.
         self.write_bytes(b"\xFE\x7C\x01\x02\x00" +
             bytes(chr(percent_played), "utf8"))
+        self.flush_bytes()
 
     def plugin_on_song_started(self, song):
 
         if self._failed_initialization() or song is None:
             return
 
+        self.resume_ticks()
         self._npld.reset()
-        self._npld.set_basic_info(song("artist"), song("title"))
-        self._npld.set_disc_info(song("album"),
-            song.get("discnumber"), song.get("tracknumber"))
         self.reset_lcd()
+        self.flush_bytes()
+
+        # Transliteration can be slow for long non-Latin texts,
+        # so prepare the song data outside of the main thread.
+        self._song = song
+        threading.Thread(target=self._prepare_song,
+            args=(song, song("artist"), song("title"), song("album"),
+                song.get("discnumber"), song.get("tracknumber")),
+            daemon=True).start()
+
+    def _prepare_song(self, song, *tags):
+
+        info = self._npld.prepare_info(*tags)
+        GLib.idle_add(self._install_song, song, info)
+
+    def _install_song(self, song, info):
+
+        # Ignore data for a song which is no longer playing.
+        if song is self._song:
+            self._npld.set_info(info)
+        return False
 
     def plugin_on_song_ended(self, song, stopped):
 
         if self._failed_initialization():
             return
 
+        self._song = None
         self._npld.reset()
         self.write_header_with_text(_("* not playing *"))
 